@@ -1,30 +1,133 @@
 # app/auth.py
 import os
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import math
+import time
 from datetime import datetime, timedelta, timezone
-from passlib.context import CryptContext
-from jose import jwt, JWTError
+import bcrypt
+
+from .schemas import MAX_PASSWORD_BYTES
+
+class JWTError(Exception):
+    """Raised by decode_access_token for a malformed, forged or expired token."""
 
 # Reads the secret key securely from environment variables
 SECRET_KEY = os.getenv("JWT_SECRET_KEY", "fallback-key-for-local-testing-only")
-ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# --- PASSWORD HASHING ---
+# One fixed cost for every process: 12, passlib's old default and so the cost existing
+# hashes use, unless BCRYPT_ROUNDS overrides it (never below the OWASP floor of 10).
+# The cost isn't timed at startup, since workers could each land on a different one;
+# run `python -m app.auth` on the target host for a recommended BCRYPT_ROUNDS.
+BCRYPT_DEFAULT_ROUNDS = 12
+BCRYPT_MIN_ROUNDS = 10
+BCRYPT_MAX_ROUNDS = 14
+BCRYPT_TARGET_SECONDS = 0.25
+
+def _calibrate_bcrypt_rounds() -> int:
+    # The largest cost whose hash fits in BCRYPT_TARGET_SECONDS on this host. Each extra
+    # round doubles the work, so one timing at the floor is enough to extrapolate.
+    start = time.perf_counter()
+    bcrypt.hashpw(b"calibration", bcrypt.gensalt(rounds=BCRYPT_MIN_ROUNDS))
+    elapsed = time.perf_counter() - start
+    headroom = int(math.log2(BCRYPT_TARGET_SECONDS / elapsed)) if elapsed < BCRYPT_TARGET_SECONDS else 0
+    return min(BCRYPT_MIN_ROUNDS + headroom, BCRYPT_MAX_ROUNDS)
+
+def _bcrypt_rounds() -> int:
+    # An explicit BCRYPT_ROUNDS is still held to the floor; only the test suite opts out
+    # of it (with BCRYPT_ALLOW_WEAK_ROUNDS=1) to hash at cost 4.
+    rounds = int(os.getenv("BCRYPT_ROUNDS", BCRYPT_DEFAULT_ROUNDS))
+    if os.getenv("BCRYPT_ALLOW_WEAK_ROUNDS") == "1":
+        return rounds
+    return max(rounds, BCRYPT_MIN_ROUNDS)
 
+BCRYPT_ROUNDS = _bcrypt_rounds()
+
+# Calls the bcrypt C library directly rather than going through passlib's
+# scheme dispatch on every hash/verify.
 def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+    # bcrypt>=5 raises past 72 bytes, where passlib silently truncated. Signup now rejects
+    # such passwords, but accounts created before that were hashed from the first 72 bytes.
+    return bcrypt.checkpw(plain_password.encode()[:MAX_PASSWORD_BYTES], hashed_password.encode())
 
 def get_password_hash(password: str) -> str:
-    return pwd_context.hash(password)
+    return bcrypt.hashpw(password.encode(), bcrypt.gensalt(rounds=BCRYPT_ROUNDS)).decode()
+
+# Verified against when a login names an unknown email, so that path costs the same
+# bcrypt time as a wrong password and response times don't reveal which accounts exist.
+# That only holds if it shares the stored hashes' cost, hence the fixed BCRYPT_ROUNDS.
+DUMMY_PASSWORD_HASH = get_password_hash("x" * 8)
+
+# bcrypt releases the GIL while hashing, so worker threads keep the event loop free and
+# still run logins in parallel across cores, without a process pool to manage.
+async def averify_password(plain_password: str, hashed_password: str) -> bool:
+    """Non-blocking verify_password for use inside async routes."""
+    return await asyncio.to_thread(verify_password, plain_password, hashed_password)
+
+async def aget_password_hash(password: str) -> str:
+    """Non-blocking get_password_hash for use inside async routes."""
+    return await asyncio.to_thread(get_password_hash, password)
+
+def _b64url(data: bytes) -> bytes:
+    return base64.urlsafe_b64encode(data).rstrip(b"=")
+
+def _b64url_decode(data: bytes) -> bytes:
+    decoded = base64.urlsafe_b64decode(data + b"=" * (-len(data) % 4))
+    # The decoder skips stray characters and ignores unused trailing bits, so several
+    # spellings decode alike; only the one _b64url itself produces is accepted.
+    if _b64url(decoded) != data:
+        raise ValueError("Non-canonical base64url segment")
+    return decoded
+
+# The HS256 header and signing key never change, so they are encoded once here and
+# each token only costs a payload dump plus one HMAC.
+_JWT_HEADER_B64 = _b64url(b'{"alg":"HS256","typ":"JWT"}')
+_SECRET_KEY_BYTES = SECRET_KEY.encode()
 
 def create_access_token(data: dict, expires_delta: timedelta | None = None) -> str:
     to_encode = data.copy()
+    now = datetime.now(timezone.utc)
     if expires_delta:
-        expire = datetime.now(timezone.utc) + expires_delta
+        expire = now + expires_delta
     else:
-        expire = datetime.now(timezone.utc) + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+        expire = now + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     
-    to_encode.update({"exp": expire, "iat": datetime.now(timezone.utc)})
+    to_encode.update({"exp": int(expire.timestamp()), "iat": int(now.timestamp())})
     
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
-    return encoded_jwt
\ No newline at end of file
+    payload_b64 = _b64url(json.dumps(to_encode, separators=(",", ":")).encode())
+    signing_input = _JWT_HEADER_B64 + b"." + payload_b64
+    signature = hmac.new(_SECRET_KEY_BYTES, signing_input, hashlib.sha256).digest()
+    return (signing_input + b"." + _b64url(signature)).decode()
+
+def decode_access_token(token: str) -> dict:
+    """
+    Verifies a token issued by create_access_token and returns its claims.
+    Raises JWTError if the header, signature or expiry is not valid.
+    """
+    try:
+        header_b64, payload_b64, signature_b64 = token.encode().split(b".")
+        # Only our own HS256 header is accepted, so no algorithm negotiation is needed
+        if not hmac.compare_digest(header_b64, _JWT_HEADER_B64):
+            raise JWTError("Unexpected token header")
+        expected = hmac.new(_SECRET_KEY_BYTES, header_b64 + b"." + payload_b64, hashlib.sha256).digest()
+        if not hmac.compare_digest(_b64url_decode(signature_b64), expected):
+            raise JWTError("Signature verification failed")
+        payload = json.loads(_b64url_decode(payload_b64))
+    except (ValueError, TypeError) as exc:
+        # Covers bad segment counts, base64/UTF-8 errors and malformed JSON
+        raise JWTError("Malformed token") from exc
+
+    if not isinstance(payload, dict) or not isinstance(payload.get("exp"), int):
+        raise JWTError("Malformed token claims")
+    if payload["exp"] <= time.time():
+        raise JWTError("Signature has expired")
+    return payload
+
+
+if __name__ == "__main__":
+    print(f"Recommended BCRYPT_ROUNDS for this host: {_calibrate_bcrypt_rounds()}")
@@ -1,60 +1,188 @@
 # app/conftest.py
-import pytest
 import os
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from fastapi.testclient import TestClient
+import pytest
+from contextlib import asynccontextmanager
+from httpx import ASGITransport, AsyncClient
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.pool import StaticPool
+from app.test_config import (
+    BCRYPT_ROUNDS, TEST_DATABASE_URL, TEST_DB_ON_DISK, TEST_MEMBER, TEST_ADMIN, TEST_TRAINER, class_payload
+)
+
+# Must be set before app.auth is imported (it reads the cost once at import); costs
+# below bcrypt's production floor need the explicit opt-in
+os.environ.setdefault("BCRYPT_ROUNDS", str(BCRYPT_ROUNDS))
+os.environ.setdefault("BCRYPT_ALLOW_WEAK_ROUNDS", "1")
+
 from app.database import Base, get_db
 from app.main import app
+from app.auth import create_access_token, get_password_hash
+from app.models import DBUser
 
-# 1. Configuration (No separate file needed for simplicity)
-TEST_DATABASE_URL = "sqlite:///./test.db" 
+@asynccontextmanager
+async def _request_transaction(db):
+    """Commits once the request is done, like get_db, and rolls back if it failed."""
+    try:
+        yield db
+        await db.commit()
+    except Exception:
+        await db.rollback()
+        raise
 
 # --- Fixtures ---
+# Everything runs on one session-wide event loop (see pytest.ini), shared by the
+# app, the async engine and the tests.
 
 @pytest.fixture(scope="session")
-def db_engine():
-    """Sets up the database engine for the entire session."""
-    engine = create_engine(
-        TEST_DATABASE_URL, connect_args={"check_same_thread": False}
-    )
-    # Create tables before the session starts
-    Base.metadata.create_all(bind=engine)
+def db_url(tmp_path_factory):
+    """The test database URL; on-disk runs get a new file per session, so no state leaks between runs."""
+    if TEST_DB_ON_DISK:
+        # pytest keeps the last few basetemp dirs, so the file can be inspected after the run
+        return f"sqlite+aiosqlite:///{tmp_path_factory.mktemp('db') / 'test.db'}"
+    return TEST_DATABASE_URL
+
+@pytest.fixture(scope="session")
+async def db_engine(db_url):
+    """Sets up the database engine and schema for the entire session."""
+    # StaticPool hands every checkout the same connection, so the whole run shares
+    # one in-memory database.
+    engine = create_async_engine(db_url, poolclass=StaticPool)
+
+    # The sqlite driver's own transaction handling breaks SAVEPOINTs, which the
+    # per-test rollback relies on; let SQLAlchemy emit BEGIN itself instead.
+    @event.listens_for(engine.sync_engine, "connect")
+    def configure_connection(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+        # Only matters for file-based runs: keep the journal in RAM and skip fsyncs
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=MEMORY")
+        cursor.execute("PRAGMA synchronous=OFF")
+        cursor.close()
+
+    @event.listens_for(engine.sync_engine, "begin")
+    def emit_begin(conn):
+        conn.exec_driver_sql("BEGIN")
+
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
     yield engine
-    # Cleanup: Drop tables and delete the file after the session ends
-    Base.metadata.drop_all(bind=engine)
-    if os.path.exists("./test.db"):
-        os.remove("./test.db")
+    await engine.dispose()
 
 @pytest.fixture(scope="session")
-def db_session(db_engine):
-    """Creates a single database session for the dependency override."""
-    TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=db_engine)
-    db_session = TestingSessionLocal()
-    yield db_session
-    db_session.close()
+def db_sessionmaker(db_engine):
+    """Session factory for setup that must outlive a single test (e.g. the auth fixtures)."""
+    return async_sessionmaker(db_engine, autoflush=False, expire_on_commit=False)
 
 @pytest.fixture(scope="session")
-def client(db_session):
-    """Overrides the get_db dependency and provides a TestClient."""
-    
+async def client(db_sessionmaker):
+    """Overrides the get_db dependency and provides an in-process async client."""
+
     # 1. Dependency Override Function
-    def override_get_db():
-        """Yields the session-scoped test session."""
-        try:
-            yield db_session
-        finally:
-            # don't close here as the session is closed in the db_session fixture yield
-            pass
+    # Used while session-scoped fixtures are set up: each request gets its own session,
+    # whose commits persist for the whole run. The db_session fixture swaps in the
+    # current test's session for the duration of each test.
+    async def override_get_db():
+        async with db_sessionmaker() as db, _request_transaction(db):
+            yield db
 
     # 2. Apply the Override
     app.dependency_overrides[get_db] = override_get_db
-    
-    # 3. Create the Test Client
-    # TestClient internally uses httpx.Client and is fully compatible with FastAPI
-    # This structure is highly stable and avoids scope/async issues.
-    with TestClient(app) as test_client:
+
+    # 3. Create the Client
+    # ASGITransport calls the app directly on the test's event loop: no server thread,
+    # no sockets. (The app lifespan isn't run; db_engine creates the schema.)
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as test_client:
         yield test_client
-    
+
     # 4. Clean up the Override (Good practice)
-    app.dependency_overrides.clear()
\ No newline at end of file
+    app.dependency_overrides.clear()
+
+@pytest.fixture(autouse=True)
+async def db_session(db_engine):
+    """
+    Wraps each test in a transaction that is rolled back afterwards.
+    The app's commits inside the test only release a SAVEPOINT, so no test sees another's writes.
+    """
+    conn = await db_engine.connect()
+    trans = await conn.begin()
+    session = AsyncSession(
+        bind=conn,
+        join_transaction_mode="create_savepoint",
+        autoflush=False,
+        expire_on_commit=False,
+    )
+
+    async def override_get_db():
+        # don't close here as the session is closed below, once the test is done
+        async with _request_transaction(session):
+            yield session
+
+    previous_override = app.dependency_overrides.get(get_db)
+    app.dependency_overrides[get_db] = override_get_db
+    yield session
+    if previous_override is None:
+        del app.dependency_overrides[get_db]
+    else:
+        app.dependency_overrides[get_db] = previous_override
+    await session.close()
+    await trans.rollback()
+    await conn.close()
+
+# --- Auth Fixtures ---
+# The three test users are seeded once per test session (committed outside any test's
+# transaction) and each role gets a token minted in-process, skipping bcrypt verification
+# and the /token round-trip; the login tests exercise /token itself. Tests ask for the
+# role they need and get back {"token": ..., "id": ...}.
+
+@pytest.fixture(scope="session")
+async def seed_users(db_sessionmaker):
+    """Inserts the member, admin and trainer in one transaction; returns them keyed by email."""
+    users = [
+        DBUser(
+            name=data["name"],
+            email=data["email"],
+            hashed_password=get_password_hash(data["password"]),
+            role=data.get("role", "member"),
+        )
+        for data in (TEST_MEMBER, TEST_ADMIN, TEST_TRAINER)
+    ]
+    async with db_sessionmaker() as db:
+        db.add_all(users)
+        await db.commit()
+    return {user.email: user for user in users}
+
+def _auth(user):
+    """Mints a token with the same claims /token signs and pairs it with the user's ID."""
+    token = create_access_token(
+        data={"sub": str(user.id), "email": user.email, "name": user.name, "roles": [user.role]}
+    )
+    return {"token": token, "id": user.id}
+
+@pytest.fixture(scope="session")
+def member_auth(seed_users):
+    """Token for the test member."""
+    return _auth(seed_users[TEST_MEMBER["email"]])
+
+@pytest.fixture(scope="session")
+def admin_auth(seed_users):
+    """Token for the test admin."""
+    return _auth(seed_users[TEST_ADMIN["email"]])
+
+@pytest.fixture(scope="session")
+def trainer_auth(seed_users):
+    """Token for the test trainer."""
+    return _auth(seed_users[TEST_TRAINER["email"]])
+
+# --- Class Fixtures ---
+
+@pytest.fixture(scope="session")
+async def created_class(client, trainer_auth):
+    """Creates the shared test class once per session; bookings made by tests are rolled back."""
+    response = await client.post(
+        "/classes",
+        headers={"Authorization": f"Bearer {trainer_auth['token']}"},
+        json=class_payload(trainer_auth["id"])
+    )
+    assert response.status_code == 201
+    return response.json()
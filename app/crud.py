@@ -1,22 +1,25 @@
 # app/crud.py
-from sqlalchemy.orm import Session
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
 from . import models, schemas
-from .auth import get_password_hash
+from .auth import aget_password_hash
 
 # --- USER CRUD OPERATIONS ---
 
-def get_user_by_email(db: Session, email: str):
+async def get_user_by_email(db: AsyncSession, email: str):
     """Retrieves a user object by their email address."""
-    return db.query(models.DBUser).filter(models.DBUser.email == email).first()
+    result = await db.execute(select(models.DBUser).where(models.DBUser.email == email))
+    return result.scalar_one_or_none()
 
-def get_user_by_id(db: Session, user_id: int):
+async def get_user_by_id(db: AsyncSession, user_id: int):
     """Retrieves a user object by their primary key ID."""
-    return db.query(models.DBUser).filter(models.DBUser.id == user_id).first()
+    result = await db.execute(select(models.DBUser).where(models.DBUser.id == user_id))
+    return result.scalar_one_or_none()
 
-def create_user(db: Session, user: schemas.UserCreate):
+async def create_user(db: AsyncSession, user: schemas.UserCreate):
     """Creates a new user, automatically hashing the password and setting the role to 'member'."""
     # Note: role is fixed to 'member' on public registration
-    hashed_password = get_password_hash(user.password)
+    hashed_password = await aget_password_hash(user.password)
     db_user = models.DBUser(
         email=user.email,
         name=user.name,
@@ -24,63 +27,69 @@ def create_user(db: Session, user: schemas.UserCreate):
         hashed_password=hashed_password
     )
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    await db.flush()  # assigns db_user.id; the caller's transaction commits it
     return db_user
 
-def update_user_role(db: Session, user_id: int, role: schemas.UserRole):
+async def update_user_role(db: AsyncSession, user_id: int, role: schemas.UserRole):
     """Updates the role of a user (Admin-only access required)."""
-    db_user = get_user_by_id(db, user_id)
+    db_user = await get_user_by_id(db, user_id)
     if db_user:
         db_user.role = role
-        db.commit()
-        db.refresh(db_user)
+        await db.flush()
     return db_user
 
 # --- CLASS CRUD OPERATIONS (Trainer/Admin Management) ---
 
-def create_class(db: Session, gym_class: schemas.ClassCreate):
+async def create_class(db: AsyncSession, gym_class: schemas.ClassCreate):
     """Creates a new gym class template."""
     # Note: model_dump() safely converts the Pydantic model to a dict for the SQLAlchemy model
     db_class = models.DBClass(**gym_class.model_dump())
     db.add(db_class)
-    db.commit()
-    db.refresh(db_class)
+    await db.flush()
     return db_class
 
-def get_classes(db: Session, skip: int = 0, limit: int = 100):
+async def get_classes(db: AsyncSession, skip: int = 0, limit: int = 100):
     """Retrieves a list of all available gym classes."""
-    return db.query(models.DBClass).offset(skip).limit(limit).all()
+    result = await db.execute(select(models.DBClass).offset(skip).limit(limit))
+    return result.scalars().all()
 
-def get_class_by_id(db: Session, class_id: int):
+async def get_class_by_id(db: AsyncSession, class_id: int):
     """Retrieves a single class by its ID."""
-    return db.query(models.DBClass).filter(models.DBClass.id == class_id).first()
+    result = await db.execute(select(models.DBClass).where(models.DBClass.id == class_id))
+    return result.scalar_one_or_none()
 
 # --- BOOKING CRUD OPERATIONS (Member/User Actions) ---
 
-def create_booking(db: Session, class_id: int, member_id: int):
+async def create_booking(db: AsyncSession, class_id: int, member_id: int):
     """
     Creates a booking for a user in a specific class, enforcing capacity limits.
     Returns: DBBooking object on success, "Capacity Full" string on failure, or None if class not found.
     """
-    # 1. Check if the class exists
-    gym_class = get_class_by_id(db, class_id)
-    if not gym_class:
-        return None
-    
-    # 2. Check current capacity
-    current_bookings = db.query(models.DBBooking).filter(models.DBBooking.class_id == class_id).count()
-    
-    if current_bookings >= gym_class.max_capacity:
-        return "Capacity Full" 
+    # 1. Claim a seat: a single row-locked UPDATE both checks and bumps the counter
+    stmt = (
+        update(models.DBClass)
+        .where(
+            models.DBClass.id == class_id,
+            models.DBClass.current_bookings < models.DBClass.max_capacity,
+        )
+        .values(current_bookings=models.DBClass.current_bookings + 1)
+        .returning(models.DBClass.id)
+    )
+    claimed = (await db.execute(stmt)).first()
+
+    # 2. No seat claimed: work out why (only on the failure path)
+    if claimed is None:
+        if not await get_class_by_id(db, class_id):
+            return None
+        return "Capacity Full"
 
-    # 3. Create the booking
+    # 3. Create the booking in the same transaction as the counter update
     db_booking = models.DBBooking(class_id=class_id, member_id=member_id)
     db.add(db_booking)
-    db.commit()
-    db.refresh(db_booking)
+    await db.flush()
     return db_booking
 
-def get_bookings_by_member(db: Session, member_id: int):
+async def get_bookings_by_member(db: AsyncSession, member_id: int):
     """Retrieves all class bookings made by a specific user."""
-    return db.query(models.DBBooking).filter(models.DBBooking.member_id == member_id).all()
\ No newline at end of file
+    result = await db.execute(select(models.DBBooking).where(models.DBBooking.member_id == member_id))
+    return result.scalars().all()
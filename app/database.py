@@ -1,7 +1,7 @@
 # app/database.py
 import os
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import declarative_base
 
 # --- PostgreSQL Integration ---
 # Using DATABASE_URL environment variable for production, 
@@ -11,22 +11,57 @@ DATABASE_URL = os.environ.get(
     "sqlite:///./sql_app.db"  # Local fallback
 )
 
-connect_args = {}
+def to_async_url(url: str) -> str:
+    """
+    Points a postgres/sqlite URL (as handed out by Render) at its asyncio driver.
+    Any driver already named in the URL (e.g. postgresql+psycopg2://) is replaced,
+    since only asyncpg and aiosqlite are installed.
+    """
+    scheme, _, rest = url.partition("://")
+    dialect = scheme.split("+", 1)[0]
+    if dialect in ("postgres", "postgresql"):
+        return "postgresql+asyncpg://" + rest
+    if dialect == "sqlite":
+        return "sqlite+aiosqlite://" + rest
+    return url
+
 if DATABASE_URL.startswith("sqlite"):
-    connect_args["check_same_thread"] = False
+    engine_kwargs = {}
+else:
+    # Keep warm connections around, test them before use (PgBouncer/Render drop
+    # idle ones) and recycle them before the server side times them out.
+    engine_kwargs = {
+        "pool_size": 20,
+        "max_overflow": 40,
+        "pool_pre_ping": True,
+        "pool_recycle": 1800,
+    }
+    # Behind a transaction pooler (PgBouncer, Supabase/Render pooling) a connection can change
+    # between statements, so asyncpg's per-connection prepared statement cache must be off.
+    if os.getenv("DB_TRANSACTION_POOLER") == "1":
+        engine_kwargs["connect_args"] = {"statement_cache_size": 0}
 
-engine = create_engine(
-    DATABASE_URL, 
-    connect_args=connect_args
+# The crud layer uses select()/insert()/update() constructs, which are cached by
+# the engine's compiled-statement cache; the size is pinned here explicitly.
+engine = create_async_engine(
+    to_async_url(DATABASE_URL), 
+    query_cache_size=500,
+    **engine_kwargs
 )
 
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# expire_on_commit=False: attributes can't be lazily reloaded after a commit
+# under asyncio, so objects stay readable once committed.
+SessionLocal = async_sessionmaker(engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
 Base = declarative_base()
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
\ No newline at end of file
+async def get_db():
+    # One transaction per request: CRUD helpers only flush, and the request's
+    # writes are committed together here (or rolled back if the route raised).
+    async with SessionLocal() as db:
+        try:
+            yield db
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            raise
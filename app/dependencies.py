@@ -1,56 +1,101 @@
 # app/dependencies.py
+import time
+from cachetools import TLRUCache
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import Annotated
 
-from . import schemas, crud
+from . import crud, schemas
 from .database import get_db
-from .auth import SECRET_KEY, ALGORITHM, jwt, JWTError
+from .auth import decode_access_token, JWTError
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/token")
 
-DB_DEPENDENCY = Annotated[Session, Depends(get_db)]
+# scope="function" commits before the response is sent, so clients never read ahead of it
+DB_DEPENDENCY = Annotated[AsyncSession, Depends(get_db, scope="function")]
+
+# --- AUTHENTICATED USER CACHE ---
+# Skips the signature check and claim validation for tokens seen recently.
+# Entries live for at most TOKEN_CACHE_SECONDS and never past the token's own expiry.
+TOKEN_CACHE_SECONDS = 30
+
+def _token_ttu(token: str, entry: tuple[float, schemas.UserPublic], now: float) -> float:
+    expires_at, _ = entry
+    return min(now + TOKEN_CACHE_SECONDS, expires_at)
+
+_user_cache = TLRUCache(maxsize=10_000, ttu=_token_ttu, timer=time.time)
 
 async def get_current_user(
-    db: DB_DEPENDENCY,
     token: Annotated[str, Depends(oauth2_scheme)]
 ) -> schemas.UserPublic:
+    cached = _user_cache.get(token)
+    if cached is not None:
+        return cached[1]
+
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        email: str = payload.get("sub")
+        payload = decode_access_token(token)
         roles_list: list[schemas.UserRole] = payload.get("roles", []) 
         
-        if email is None or not roles_list:
+        if not roles_list:
             raise credentials_exception
         
-        # token_data = schemas.TokenData(email=email, roles=roles_list) # Not strictly needed
-    except JWTError:
+        # The profile is signed into the token at login, so no DB lookup is needed here.
+        # Role changes therefore take effect the next time the user logs in, except on
+        # admin-only routes, which re-read the role (see fresh_role_checker).
+        current_user = schemas.UserPublic(
+            id=int(payload["sub"]),
+            email=payload["email"],
+            name=payload["name"],
+            role=roles_list[0],
+        )
+    except (JWTError, KeyError, ValueError):
+        # ValueError also covers pydantic's ValidationError (e.g. pre-upgrade tokens)
         raise credentials_exception
 
-    db_user = crud.get_user_by_email(db, email=email)
-    if db_user is None:
-        raise credentials_exception
-    
-    return schemas.UserPublic.model_validate(db_user)
+    _user_cache[token] = (payload["exp"], current_user)
+    return current_user
 
 
 def role_checker(required_roles: list[schemas.UserRole]):
+    # Built once per checker rather than on every request
+    allowed_roles = frozenset(required_roles)
+    forbidden_detail = f"Not enough permissions. Required roles: {', '.join(required_roles)}"
+
     def wrapper(current_user: Annotated[schemas.UserPublic, Depends(get_current_user)]):
-        if current_user.role not in required_roles:
+        if current_user.role not in allowed_roles:
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail=forbidden_detail,
+            )
+        return current_user
+    return wrapper
+
+def fresh_role_checker(required_roles: list[schemas.UserRole]):
+    # For privilege-changing routes: checks the caller's current role in the DB rather than
+    # the one signed into the token, so a demoted or deleted admin loses access immediately.
+    allowed_roles = frozenset(required_roles)
+    forbidden_detail = f"Not enough permissions. Required roles: {', '.join(required_roles)}"
+
+    async def wrapper(
+        current_user: Annotated[schemas.UserPublic, Depends(get_current_user)],
+        db: DB_DEPENDENCY,
+    ):
+        db_user = await crud.get_user_by_id(db, user_id=current_user.id)
+        if db_user is None or db_user.role not in allowed_roles:
             raise HTTPException(
                 status_code=status.HTTP_403_FORBIDDEN,
-                detail=f"Not enough permissions. Required roles: {', '.join(required_roles)}",
+                detail=forbidden_detail,
             )
         return current_user
     return wrapper
 
 # Pre-defined dependencies
-ADMIN_ONLY = role_checker(["admin"])
+ADMIN_ONLY = fresh_role_checker(["admin"])
 TRAINER_OR_ADMIN = role_checker(["admin", "trainer"])
 CURRENT_USER_DEPENDENCY = Annotated[schemas.UserPublic, Depends(get_current_user)]
\ No newline at end of file
@@ -1,23 +1,64 @@
 # app/main.py
+import os
+import asyncio
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordRequestForm
 from typing import Annotated
+from sqlalchemy import inspect, text
 
 
 # Absolute imports works because Uvicorn is run from the project root
 from . import models, schemas, crud, auth
-from .database import engine, get_db
+from .database import engine, get_db, DATABASE_URL
 from .dependencies import (
     CURRENT_USER_DEPENDENCY, ADMIN_ONLY, TRAINER_OR_ADMIN, DB_DEPENDENCY
 )
 
-# Initialize the database and create tables on startup
-# This command connects to PostgreSQL and ensures the tables exist.
-models.Base.metadata.create_all(bind=engine)
+async def upgrade_schema(conn):
+    """
+    Brings tables created by older versions up to date, since create_all never alters an
+    existing table. Each step checks before it changes anything, so it is safe to rerun.
+    """
+    class_columns = await conn.run_sync(
+        lambda sync_conn: {column["name"] for column in inspect(sync_conn).get_columns("classes")}
+    )
+    if "current_bookings" not in class_columns:
+        await conn.execute(text(
+            "ALTER TABLE classes ADD COLUMN current_bookings INTEGER NOT NULL DEFAULT 0"
+        ))
+        await conn.execute(text(
+            "UPDATE classes SET current_bookings = "
+            "(SELECT COUNT(*) FROM bookings WHERE bookings.class_id = classes.id)"
+        ))
+
+    # Foreign-key indexes for the class listing and booking lookups (names as create_all makes them)
+    for index, table, column in [
+        ("ix_classes_trainer_id", "classes", "trainer_id"),
+        ("ix_bookings_class_id", "bookings", "class_id"),
+        ("ix_bookings_member_id", "bookings", "member_id"),
+    ]:
+        await conn.execute(text(f"CREATE INDEX IF NOT EXISTS {index} ON {table} ({column})"))
+
+async def init_db():
+    """Creates any missing tables and upgrades existing ones. Deploys run this once via `python -m app.main`."""
+    async with engine.begin() as conn:
+        await conn.run_sync(models.Base.metadata.create_all)
+        await upgrade_schema(conn)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Checking every table costs a round trip to PostgreSQL, so workers skip it unless
+    # INIT_DB=1. The local SQLite fallback is cheap and always initialized.
+    if os.getenv("INIT_DB") == "1" or DATABASE_URL.startswith("sqlite"):
+        await init_db()
+    yield
+    await engine.dispose()
 
 app = FastAPI(
     title="A RBAC Gym API",
     description="JWT Authentication and Role-Based Access Control using Python/FastAPI and PostgreSQL.",
+    lifespan=lifespan,
 )
 
 # --- USER AUTHENTICATION & PROFILE ROUTES ---
@@ -25,28 +66,31 @@ app = FastAPI(
 @app.post("/register", response_model=schemas.UserPublic, status_code=status.HTTP_201_CREATED)
 async def register_user(user_data: schemas.UserCreate, db: DB_DEPENDENCY):
     """Register a new user with the default 'member' role."""
-    db_user = crud.get_user_by_email(db, email=user_data.email)
+    db_user = await crud.get_user_by_email(db, email=user_data.email)
     if db_user:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Email already registered")
     
-    new_user = crud.create_user(db, user=user_data)
-    return schemas.UserPublic.model_validate(new_user)
+    new_user = await crud.create_user(db, user=user_data)
+    return new_user
 
 @app.post("/token", response_model=schemas.Token)
 async def login_for_access_token(form_data: Annotated[OAuth2PasswordRequestForm, Depends()], db: DB_DEPENDENCY):
     """Generates an access token upon successful login."""
-    user = crud.get_user_by_email(db, email=form_data.username)
+    user = await crud.get_user_by_email(db, email=form_data.username)
     
-    if not user or not auth.verify_password(form_data.password, user.hashed_password):
+    # Always run bcrypt, even for unknown emails, so timing doesn't leak account existence
+    password_hash = user.hashed_password if user else auth.DUMMY_PASSWORD_HASH
+    password_ok = await auth.averify_password(form_data.password, password_hash)
+    if not user or not password_ok:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
     
-    # Create the JWT payload, including the user's single role
+    # Create the JWT payload, including the user's public profile and single role
     access_token = auth.create_access_token(
-        data={"sub": user.email, "roles": [user.role]},
+        data={"sub": str(user.id), "email": user.email, "name": user.name, "roles": [user.role]},
         expires_delta=auth.timedelta(minutes=auth.ACCESS_TOKEN_EXPIRE_MINUTES)
     )
     return {"access_token": access_token, "token_type": "bearer"}
@@ -84,11 +128,11 @@ async def update_user_role(
     db: DB_DEPENDENCY
 ):
     """Access granted only to users with the 'admin' role to change another user's role."""
-    db_user = crud.update_user_role(db, user_id=user_id, role=role_update.role)
+    db_user = await crud.update_user_role(db, user_id=user_id, role=role_update.role)
     if not db_user:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
         
-    return schemas.UserPublic.model_validate(db_user)
+    return db_user
 
 # --- CLASS MANAGEMENT ROUTES ---
 
@@ -96,12 +140,12 @@ async def update_user_role(
 async def create_new_class(class_data: schemas.ClassCreate, db: DB_DEPENDENCY):
     """Allows Trainers and Admins to create new class templates."""
     # TODO: Optional: Validate that class_data.trainer_id exists and is actually a 'trainer'
-    return crud.create_class(db, gym_class=class_data)
+    return await crud.create_class(db, gym_class=class_data)
 
 @app.get("/classes", response_model=list[schemas.ClassPublic])
 async def list_classes(db: DB_DEPENDENCY, skip: int = 0, limit: int = 100):
     """Lists all available classes (accessible to anyone, including unauthenticated users if you removed the dependency from the file)."""
-    return crud.get_classes(db, skip=skip, limit=limit)
+    return await crud.get_classes(db, skip=skip, limit=limit)
 
 
 # --- BOOKING ROUTES ---
@@ -119,9 +163,9 @@ async def book_class(
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Cannot book for another user.")
     
     # I use current_user.id for the member_id in the booking
-    result = crud.create_booking(db, 
-                                 class_id=booking_data.class_id, 
-                                 member_id=current_user.id) 
+    result = await crud.create_booking(db, 
+                                       class_id=booking_data.class_id, 
+                                       member_id=current_user.id) 
 
     if result == "Capacity Full":
         raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Class is fully booked.")
@@ -134,4 +178,8 @@ async def book_class(
 @app.get("/users/me/bookings", response_model=list[schemas.BookingPublic])
 async def get_my_bookings(current_user: CURRENT_USER_DEPENDENCY, db: DB_DEPENDENCY):
     """Returns all bookings made by the current user."""
-    return crud.get_bookings_by_member(db, member_id=current_user.id)
\ No newline at end of file
+    return await crud.get_bookings_by_member(db, member_id=current_user.id)
+
+
+if __name__ == "__main__":
+    asyncio.run(init_db())
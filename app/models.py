@@ -3,6 +3,9 @@ from sqlalchemy import Boolean, Column, Integer, String, ForeignKey
 from sqlalchemy.orm import relationship
 from .database import Base
 
+# Relationships use lazy="raise": touching one that wasn't loaded up front is an error
+# instead of a hidden per-row query (N+1). Load them in the query with selectinload(...).
+
 ## --- User Model ---
 
 class DBUser(Base):
@@ -17,9 +20,9 @@ class DBUser(Base):
 
     # Relationships
     # Classes taught by this user (if role is 'trainer')
-    classes_taught = relationship("DBClass", back_populates="trainer")
+    classes_taught = relationship("DBClass", back_populates="trainer", lazy="raise")
     # Bookings made by this user (if role is 'member' or 'admin')
-    bookings_made = relationship("DBBooking", back_populates="member")
+    bookings_made = relationship("DBBooking", back_populates="member", lazy="raise")
 
 
 ## --- Class Model ---
@@ -31,16 +34,18 @@ class DBClass(Base):
     name = Column(String, index=True, nullable=False)
     
     # Foreign Key linking to the DBUser who is the trainer
-    trainer_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    trainer_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
     
     max_capacity = Column(Integer, nullable=False)
     duration_minutes = Column(Integer, default=60)
+    # Denormalized count of bookings, kept in step by crud.create_booking
+    current_bookings = Column(Integer, default=0, nullable=False)
     
     # Relationships
     # Link back to the trainer user object
-    trainer = relationship("DBUser", back_populates="classes_taught")
+    trainer = relationship("DBUser", back_populates="classes_taught", lazy="raise")
     # Link to all bookings for this class
-    bookings = relationship("DBBooking", back_populates="class_data")
+    bookings = relationship("DBBooking", back_populates="class_data", lazy="raise")
 
 
 ## --- Booking Model ---
@@ -50,13 +55,13 @@ class DBBooking(Base):
     
     id = Column(Integer, primary_key=True, index=True)
     
-    # Foreign Key linking to the class being booked
-    class_id = Column(Integer, ForeignKey("classes.id"), nullable=False)
-    # Foreign Key linking to the user making the booking
-    member_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    # Foreign Key linking to the class being booked (indexed: capacity checks count by class)
+    class_id = Column(Integer, ForeignKey("classes.id"), nullable=False, index=True)
+    # Foreign Key linking to the user making the booking (indexed: "my bookings" lookups)
+    member_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
 
     # Relationships
     # Link back to the class object
-    class_data = relationship("DBClass", back_populates="bookings")
+    class_data = relationship("DBClass", back_populates="bookings", lazy="raise")
     # Link back to the user/member object
-    member = relationship("DBUser", back_populates="bookings_made")
\ No newline at end of file
+    member = relationship("DBUser", back_populates="bookings_made", lazy="raise")
\ No newline at end of file
@@ -1,18 +1,43 @@
 # app/schemas.py
-from pydantic import BaseModel, EmailStr, ConfigDict
-from typing import Literal
+import re
+from pydantic import AfterValidator, BaseModel, EmailStr, ConfigDict
+from typing import Annotated, Literal
 
 # --- ROLE DEFINITION ---
 UserRole = Literal["admin", "member", "trainer"]
 
+# --- EMAIL DEFINITION ---
+# A cheap shape check for emails that were already fully validated (EmailStr) at signup
+_EMAIL_RE = re.compile(r"^[^@\s]+@[^@\s]+\.[^@\s]+$")
+
+def _check_email(value: str) -> str:
+    if not _EMAIL_RE.match(value):
+        raise ValueError("value is not a valid email address")
+    return value
+
+Email = Annotated[str, AfterValidator(_check_email)]
+
+# --- PASSWORD DEFINITION ---
+# bcrypt only reads the first 72 bytes of a password, so longer ones are rejected at
+# signup (422) rather than failing inside bcrypt later
+MAX_PASSWORD_BYTES = 72
+
+def _check_password_length(value: str) -> str:
+    if len(value.encode()) > MAX_PASSWORD_BYTES:
+        raise ValueError(f"password must be at most {MAX_PASSWORD_BYTES} bytes")
+    return value
+
+Password = Annotated[str, AfterValidator(_check_password_length)]
+
 # --- USER SCHEMAS ---
 class UserBase(BaseModel):
-    email: EmailStr
+    email: Email
     name: str
     role: UserRole = "member"
 
 class UserCreate(UserBase):
-    password: str
+    email: EmailStr # Full email-validator check at the signup boundary only
+    password: Password
 
 class UserUpdateRole(BaseModel):
     role: UserRole
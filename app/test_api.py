@@ -1,333 +1,425 @@
 # app/test_api.py
+import base64
+import bcrypt
 import pytest
-from app.schemas import UserCreate
-from app.crud import get_user_by_email, create_user
-from app.database import get_db
-
-# --- TEST DATA ---
-TEST_MEMBER = {
-    "name": "Test Member",
-    "email": "member@test.com",
-    "password": "testpassword"
-}
-TEST_ADMIN = {
-    "name": "Test Admin",
-    "email": "admin@test.com",
-    "password": "adminpassword",
-    "role": "admin"
-}
-TEST_TRAINER = {
-    "name": "Test Trainer",
-    "email": "trainer@test.com",
-    "password": "trainerpassword",
-    "role": "trainer"
-}
-TEST_CLASS_DATA = {
-    "name": "Morning Yoga",
-    "max_capacity": 10,
-    "duration_minutes": 75
-}
-
-# Store tokens and global IDs for re-use in subsequent tests
-member_token = None
-admin_token = None
-trainer_token = None
-class_id = None
-
-
-# --- HELPER FUNCTIONS ---
-
-def get_member_token(client):
-    """Registers and logs in a member, returns the token."""
-    global member_token
-    if member_token:
-        return member_token
-    
-    client.post("/register", json=TEST_MEMBER)
-    
-    # Login
-    response = client.post(
-        "/token", 
-        data={"username": TEST_MEMBER["email"], "password": TEST_MEMBER["password"]},
-        headers={"Content-Type": "application/x-www-form-urlencoded"}
-    )
-    assert response.status_code == 200
-    member_token = response.json()["access_token"]
-    return member_token
-
-def get_admin_token(client, db_session):
-    """Registers and promotes an admin, returns the token."""
-    global admin_token
-    if admin_token:
-        return admin_token
-
-    # 1. Ensure user is created and promoted using the passed db_session
-    admin_data = UserCreate(**TEST_ADMIN)
-    db_admin = get_user_by_email(db_session, admin_data.email)
-    if not db_admin:
-        db_admin = create_user(db_session, user=admin_data)
-        db_admin.role = "admin" 
-        db_session.commit()
-    
-    # 2. Login
-    response = client.post(
-        "/token", 
-        data={"username": TEST_ADMIN["email"], "password": TEST_ADMIN["password"]},
-        headers={"Content-Type": "application/x-www-form-urlencoded"}
-    )
-    assert response.status_code == 200
-    admin_token = response.json()["access_token"]
-    return admin_token
-
-def get_trainer_token(client, db_session):
-    """Registers and promotes a trainer, returns the token."""
-    global trainer_token
-    if trainer_token:
-        return trainer_token
-
-    # 1. Ensure user is created and promoted using the passed db_session
-    trainer_data = UserCreate(**TEST_TRAINER)
-    db_trainer = get_user_by_email(db_session, trainer_data.email)
-    if not db_trainer:
-        db_trainer = create_user(db_session, user=trainer_data)
-        db_trainer.role = "trainer" 
-        db_session.commit()
-    
-    # 2. Login
-    response = client.post(
-        "/token", 
-        data={"username": TEST_TRAINER["email"], "password": TEST_TRAINER["password"]},
-        headers={"Content-Type": "application/x-www-form-urlencoded"}
-    )
-    assert response.status_code == 200
-    trainer_token = response.json()["access_token"]
-    return trainer_token
-
-# --- CRITICAL FIX FOR ATTRIBUTEERROR ---
-def get_user_id_by_email(db_session, email):
-    """Helper to fetch the ID of a user from the DB."""
-    # We must use the session passed to the test (db_session) to find users
-    # created by the token helpers in the same test session scope.
-    from app.crud import get_user_by_email
-    
-    # Attempt to retrieve the user using the test session
-    user = get_user_by_email(db_session, email)
-    
-    if user is None:
-        # If the user is None, it means the necessary get_*_token helper 
-        # that registers the user was NOT called before this function.
-        raise ValueError(f"CRITICAL: User with email {email} not found in the test session. Ensure the corresponding get_*_token helper was called correctly before retrieving the ID.")
-        
-    return user.id
-
+from datetime import timedelta
+from types import SimpleNamespace
+from fastapi import HTTPException
+from sqlalchemy import text, update
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from app import auth, crud, database
+from app.auth import create_access_token
+from app.database import Base, get_db, to_async_url
+from app.main import app, upgrade_schema
+from app.models import DBUser
+from app.test_config import TEST_MEMBER, class_payload
 
 # --- CORE AUTH & USER TESTS ---
 
-def test_register_and_check_default_role(client):
+async def test_register_and_check_default_role(client):
     """Tests registration and confirms default role is 'member'."""
-    response = client.post("/register", json=TEST_MEMBER)
+    # A user of its own: TEST_MEMBER is already seeded by the auth fixtures
+    new_member = {"name": "New Member", "email": "new.member@test.com", "password": "newpassword"}
+    response = await client.post("/register", json=new_member)
     assert response.status_code == 201
     data = response.json()
-    assert data["email"] == TEST_MEMBER["email"]
+    assert data["email"] == new_member["email"]
     assert data["role"] == "member"
     
-    response_conflict = client.post("/register", json=TEST_MEMBER)
+    response_conflict = await client.post("/register", json=new_member)
     assert response_conflict.status_code == 400
 
-def test_login_and_get_profile(client):
+async def test_login_and_get_profile(client, member_auth):
     """Tests successful login and protected profile access."""
-    token = get_member_token(client)
-    
-    response = client.get(
+    # The auth fixtures mint their tokens directly, so log in through /token here
+    response = await client.post(
+        "/token",
+        data={"username": TEST_MEMBER["email"], "password": TEST_MEMBER["password"]},
+        headers={"Content-Type": "application/x-www-form-urlencoded"}
+    )
+    assert response.status_code == 200
+    token = response.json()["access_token"]
+
+    response = await client.get(
         "/users/me",
         headers={"Authorization": f"Bearer {token}"}
     )
     assert response.status_code == 200
+    assert response.json()["id"] == member_auth["id"]
+
+async def test_login_bad_credentials(client, member_auth):
+    """Tests that unknown emails and wrong passwords get the same 401."""
+    for username, password in [("nobody@test.com", "testpassword"), (TEST_MEMBER["email"], "wrongpassword")]:
+        response = await client.post(
+            "/token", 
+            data={"username": username, "password": password},
+            headers={"Content-Type": "application/x-www-form-urlencoded"}
+        )
+        assert response.status_code == 401
+        assert response.json()["detail"] == "Incorrect username or password"
+
+async def test_login_unknown_email_verifies_dummy_hash(client, monkeypatch):
+    """Tests that an unknown email still pays for a bcrypt verify, at the same cost as new hashes."""
+    verified_hashes = []
+    real_averify = auth.averify_password
+
+    async def spy_averify(plain_password, hashed_password):
+        verified_hashes.append(hashed_password)
+        return await real_averify(plain_password, hashed_password)
+
+    monkeypatch.setattr(auth, "averify_password", spy_averify)
+    response = await client.post(
+        "/token",
+        data={"username": "nobody@test.com", "password": "testpassword"},
+        headers={"Content-Type": "application/x-www-form-urlencoded"}
+    )
+    assert response.status_code == 401
+    assert verified_hashes == [auth.DUMMY_PASSWORD_HASH]
+    # A bcrypt hash reads $2b$<cost>$...
+    assert int(auth.DUMMY_PASSWORD_HASH.split("$")[2]) == auth.BCRYPT_ROUNDS
+
+async def test_overlong_password(client, member_auth):
+    """Tests that passwords past bcrypt's 72-byte limit are a 422 at signup and a plain 401 at login."""
+    long_password = "p" * 100
+    response = await client.post(
+        "/register",
+        json={"name": "Long Password", "email": "long.password@test.com", "password": long_password}
+    )
+    assert response.status_code == 422
+
+    # Both a real account and an unknown email (the dummy-hash path)
+    for username in [TEST_MEMBER["email"], "nobody@test.com"]:
+        response = await client.post(
+            "/token",
+            data={"username": username, "password": long_password},
+            headers={"Content-Type": "application/x-www-form-urlencoded"}
+        )
+        assert response.status_code == 401
+
+async def test_login_legacy_long_password(client, db_session):
+    """Tests that an account hashed by passlib from a password over 72 bytes (truncated) can still log in."""
+    long_password = "legacy-" * 15  # 105 bytes
+    db_session.add(DBUser(
+        name="Legacy User",
+        email="legacy@test.com",
+        hashed_password=bcrypt.hashpw(long_password.encode()[:72], bcrypt.gensalt(rounds=4)).decode(),
+        role="member",
+    ))
+    await db_session.flush()
+
+    response = await client.post(
+        "/token",
+        data={"username": "legacy@test.com", "password": long_password},
+        headers={"Content-Type": "application/x-www-form-urlencoded"}
+    )
+    assert response.status_code == 200
 
-def test_unauthorized_access(client):
+async def test_unauthorized_access(client):
     """Tests accessing a protected route without a token."""
-    response = client.get("/users/me")
+    response = await client.get("/users/me")
+    assert response.status_code == 401
+
+
+async def test_tampered_token_rejected(client, member_auth):
+    """Tests that a token whose payload was altered fails signature verification."""
+    header, payload, signature = member_auth["token"].split(".")
+    forged = ".".join([header, payload[:-2] + ("AA" if payload[-2:] != "AA" else "BB"), signature])
+
+    response = await client.get("/users/me", headers={"Authorization": f"Bearer {forged}"})
+    assert response.status_code == 401
+
+async def test_non_canonical_signature_rejected(client, member_auth):
+    """Tests that a signature spelled differently from our encoding (same bytes once decoded) is refused."""
+    header, payload, signature = member_auth["token"].split(".")
+    alphabet = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_"
+    # A 32-byte HMAC leaves 2 unused bits in the last character; flipping one keeps the bytes
+    unused_bits_flipped = signature[:-1] + alphabet[alphabet.index(signature[-1]) ^ 1]
+
+    for forged_signature in [unused_bits_flipped, signature + "=", signature[:10] + "*" + signature[10:]]:
+        forged = ".".join([header, payload, forged_signature])
+        response = await client.get("/users/me", headers={"Authorization": f"Bearer {forged}"})
+        assert response.status_code == 401
+
+async def test_expired_token_rejected(client, member_auth):
+    """Tests that a correctly signed token past its expiry is refused."""
+    expired = create_access_token(
+        data={"sub": str(member_auth["id"]), "email": TEST_MEMBER["email"], "name": TEST_MEMBER["name"], "roles": ["member"]},
+        expires_delta=timedelta(seconds=-1)
+    )
+    response = await client.get("/users/me", headers={"Authorization": f"Bearer {expired}"})
     assert response.status_code == 401
 
+async def test_foreign_header_rejected(client, member_auth):
+    """Tests that a token with any header other than our HS256 one (here alg=none) is refused."""
+    _, payload, _ = member_auth["token"].split(".")
+    header = base64.urlsafe_b64encode(b'{"alg":"none","typ":"JWT"}').rstrip(b"=").decode()
+
+    response = await client.get("/users/me", headers={"Authorization": f"Bearer {header}.{payload}."})
+    assert response.status_code == 401
+
+# --- PASSWORD HASHING TESTS ---
+
+@pytest.mark.parametrize("seconds_at_floor, expected_rounds", [
+    (0.5, 10),    # slow host: never below the floor
+    (0.03, 13),   # 0.03s * 2**3 = 0.24s fits the 0.25s budget, 2**4 doesn't
+    (0.0001, 14), # fast host: capped
+])
+def test_calibrate_bcrypt_rounds(monkeypatch, seconds_at_floor, expected_rounds):
+    """Tests that the calibrated cost is extrapolated from one timed hash at the floor."""
+    monkeypatch.setattr(auth.bcrypt, "hashpw", lambda password, salt: b"")
+    monkeypatch.setattr(auth, "time", SimpleNamespace(perf_counter=iter([0.0, seconds_at_floor]).__next__))
+    assert auth._calibrate_bcrypt_rounds() == expected_rounds
+
+def test_bcrypt_rounds_floor(monkeypatch):
+    """Tests the fixed default cost, and that an explicit BCRYPT_ROUNDS below 10 is raised to the floor unless allowed."""
+    monkeypatch.delenv("BCRYPT_ROUNDS")
+    monkeypatch.delenv("BCRYPT_ALLOW_WEAK_ROUNDS")
+    assert auth._bcrypt_rounds() == auth.BCRYPT_DEFAULT_ROUNDS
+
+    monkeypatch.setenv("BCRYPT_ROUNDS", "4")
+    assert auth._bcrypt_rounds() == auth.BCRYPT_MIN_ROUNDS
+
+    monkeypatch.setenv("BCRYPT_ALLOW_WEAK_ROUNDS", "1")
+    assert auth._bcrypt_rounds() == 4
 
 # --- ROLE-BASED ACCESS CONTROL (RBAC) TESTS ---
 
-def test_rbac_admin_update_role_success(client, db_session):
+async def test_rbac_admin_update_role_success(client, admin_auth, member_auth):
     """Tests Admin-only route by updating a user's role."""
-    admin_token = get_admin_token(client, db_session)
-    # The member user is created by get_member_token called in the previous tests
-    member_id = get_user_id_by_email(db_session, TEST_MEMBER['email'])
-
     # Admin attempts to change member role to 'trainer'
-    response = client.patch(
-        f"/admin/update-role/{member_id}",
-        headers={"Authorization": f"Bearer {admin_token}"},
+    response = await client.patch(
+        f"/admin/update-role/{member_auth['id']}",
+        headers={"Authorization": f"Bearer {admin_auth['token']}"},
         json={"role": "trainer"}
     )
     assert response.status_code == 200
     assert response.json()["role"] == "trainer"
-    
-    # Revert role back to 'member' for subsequent tests
-    client.patch(
-        f"/admin/update-role/{member_id}",
-        headers={"Authorization": f"Bearer {admin_token}"},
-        json={"role": "member"}
+
+async def test_role_change_applies_on_next_login(client, admin_auth, member_auth):
+    """Tests that a role change is carried by the tokens issued after it."""
+    await client.patch(
+        f"/admin/update-role/{member_auth['id']}",
+        headers={"Authorization": f"Bearer {admin_auth['token']}"},
+        json={"role": "trainer"}
+    )
+
+    # A fresh login picks up the new role
+    response = await client.post(
+        "/token", 
+        data={"username": TEST_MEMBER["email"], "password": TEST_MEMBER["password"]},
+        headers={"Content-Type": "application/x-www-form-urlencoded"}
     )
+    fresh_token = response.json()["access_token"]
+    response = await client.get("/users/me", headers={"Authorization": f"Bearer {fresh_token}"})
+    assert response.json()["role"] == "trainer"
+    assert response.json()["id"] == member_auth["id"]
+
+async def test_rbac_demoted_admin_update_role_fail(client, admin_auth, member_auth, db_session):
+    """Tests that an admin demoted after login loses admin-only access while their token is still valid."""
+    await db_session.execute(update(DBUser).where(DBUser.id == admin_auth["id"]).values(role="member"))
 
-def test_rbac_trainer_update_role_fail(client, db_session):
+    response = await client.patch(
+        f"/admin/update-role/{member_auth['id']}",
+        headers={"Authorization": f"Bearer {admin_auth['token']}"},
+        json={"role": "trainer"}
+    )
+    assert response.status_code == 403 # Forbidden
+
+async def test_rbac_trainer_update_role_fail(client, trainer_auth, member_auth):
     """Tests if a trainer is blocked from the Admin-only route."""
-    trainer_token = get_trainer_token(client, db_session)
-    member_id = get_user_id_by_email(db_session, TEST_MEMBER['email'])
-    
     # Trainer attempts to change the role
-    response = client.patch(
-        f"/admin/update-role/{member_id}",
-        headers={"Authorization": f"Bearer {trainer_token}"},
+    response = await client.patch(
+        f"/admin/update-role/{member_auth['id']}",
+        headers={"Authorization": f"Bearer {trainer_auth['token']}"},
         json={"role": "admin"}
     )
     assert response.status_code == 403 # Forbidden
 
-def test_rbac_member_access_trainer_data_fail(client, db_session):
+async def test_rbac_member_access_trainer_data_fail(client, member_auth):
     """Tests if a 'member' is blocked from the Trainer/Admin route."""
-    member_token = get_member_token(client)
-    response = client.get(
+    response = await client.get(
         "/trainer-data",
-        headers={"Authorization": f"Bearer {member_token}"}
+        headers={"Authorization": f"Bearer {member_auth['token']}"}
     )
     assert response.status_code == 403 # Forbidden
 
-def test_rbac_admin_access_trainer_data_success(client, db_session):
+async def test_rbac_admin_access_trainer_data_success(client, admin_auth):
     """Tests if an 'admin' can access the Trainer/Admin route."""
-    admin_token = get_admin_token(client, db_session)
-    response = client.get(
+    response = await client.get(
         "/trainer-data",
-        headers={"Authorization": f"Bearer {admin_token}"}
+        headers={"Authorization": f"Bearer {admin_auth['token']}"}
     )
     assert response.status_code == 200
 
 # --- CLASS MANAGEMENT TESTS ---
 
-def test_class_creation_trainer_success(client, db_session):
-    """Tests Trainer's ability to create a new class and stores the ID."""
-    global class_id
-    trainer_token = get_trainer_token(client, db_session)
-    trainer_id = get_user_id_by_email(db_session, TEST_TRAINER['email'])
-    
-    class_data = TEST_CLASS_DATA.copy()
-    class_data["trainer_id"] = trainer_id # Inject the actual trainer ID
+async def test_class_creation_trainer_success(client, trainer_auth):
+    """Tests Trainer's ability to create a new class."""
+    class_data = class_payload(trainer_auth["id"]) # Inject the actual trainer ID
 
-    response = client.post(
+    response = await client.post(
         "/classes",
-        headers={"Authorization": f"Bearer {trainer_token}"},
+        headers={"Authorization": f"Bearer {trainer_auth['token']}"},
         json=class_data
     )
     assert response.status_code == 201
-    class_id = response.json()["id"] # Store ID for booking tests
-    assert response.json()["trainer_id"] == trainer_id
+    assert response.json()["trainer_id"] == trainer_auth["id"]
 
-def test_class_creation_member_fail(client, db_session):
+async def test_class_creation_member_fail(client, member_auth, trainer_auth):
     """Tests Member's failure to create a class (RBAC check)."""
-    member_token = get_member_token(client)
-    trainer_id = get_user_id_by_email(db_session, TEST_TRAINER['email'])
-    
-    class_data = TEST_CLASS_DATA.copy()
-    class_data["trainer_id"] = trainer_id
+    class_data = class_payload(trainer_auth["id"])
 
-    response = client.post(
+    response = await client.post(
         "/classes",
-        headers={"Authorization": f"Bearer {member_token}"},
+        headers={"Authorization": f"Bearer {member_auth['token']}"},
         json=class_data
     )
     assert response.status_code == 403 # Forbidden
 
-def test_list_classes_success(client, db_session):
+async def test_list_classes_success(client, member_auth, created_class):
     """Tests that any user can view the list of classes."""
-    # Note: We pass db_session to ensure get_member_token runs first to guarantee user exists
-    token = get_member_token(client) 
-    response = client.get(
+    response = await client.get(
         "/classes",
-        headers={"Authorization": f"Bearer {token}"}
+        headers={"Authorization": f"Bearer {member_auth['token']}"}
     )
     assert response.status_code == 200
     data = response.json()
-    assert class_id is not None 
-    assert any(c["id"] == class_id for c in data)
+    assert any(c["id"] == created_class["id"] for c in data)
 
 # --- BOOKING MANAGEMENT TESTS ---
 
-def test_book_class_member_success(client, db_session):
+async def test_book_class_member_success(client, member_auth, created_class):
     """Tests a Member successfully booking a class."""
-    member_token = get_member_token(client)
-    member_id = get_user_id_by_email(db_session, TEST_MEMBER['email'])
-
     booking_data = {
-        "class_id": class_id, 
-        "member_id": member_id # Member books for themselves
+        "class_id": created_class["id"], 
+        "member_id": member_auth["id"] # Member books for themselves
     }
     
-    response = client.post(
+    response = await client.post(
         "/bookings",
-        headers={"Authorization": f"Bearer {member_token}"},
+        headers={"Authorization": f"Bearer {member_auth['token']}"},
         json=booking_data
     )
     assert response.status_code == 201
-    assert response.json()["class_id"] == class_id
+    assert response.json()["class_id"] == created_class["id"]
 
-def test_book_class_member_for_others_fail(client, db_session):
+async def test_book_class_member_for_others_fail(client, member_auth, admin_auth, created_class):
     """Tests a Member trying to book a class for a different user ID (Security Check)."""
-    member_token = get_member_token(client)
-    # The user being booked for must exist to get an ID
-    get_admin_token(client, db_session) 
-    other_user_id = get_user_id_by_email(db_session, TEST_ADMIN['email'])
-
     booking_data = {
-        "class_id": class_id, 
-        "member_id": other_user_id # Booking for another ID
+        "class_id": created_class["id"], 
+        "member_id": admin_auth["id"] # Booking for another ID
     }
     
-    response = client.post(
+    response = await client.post(
         "/bookings",
-        headers={"Authorization": f"Bearer {member_token}"},
+        headers={"Authorization": f"Bearer {member_auth['token']}"},
         json=booking_data
     )
     assert response.status_code == 403 # Forbidden
 
-def test_book_class_capacity_fail(client, db_session):
+async def test_book_class_capacity_fail(client, trainer_auth, member_auth):
     """Tests booking failure when class capacity is reached (using a class of capacity 1)."""
-    trainer_token = get_trainer_token(client, db_session)
-    trainer_id = get_user_id_by_email(db_session, TEST_TRAINER['email'])
-    member_id = get_user_id_by_email(db_session, TEST_MEMBER['email'])
-
     # 1. Create a low capacity class (Capacity: 1)
-    low_cap_data = TEST_CLASS_DATA.copy()
-    low_cap_data["trainer_id"] = trainer_id
-    low_cap_data["max_capacity"] = 1
+    low_cap_data = class_payload(trainer_auth["id"], max_capacity=1)
     
-    response = client.post("/classes", headers={"Authorization": f"Bearer {trainer_token}"}, json=low_cap_data)
+    response = await client.post("/classes", headers={"Authorization": f"Bearer {trainer_auth['token']}"}, json=low_cap_data)
     low_cap_class_id = response.json()["id"]
 
     # 2. First booking (Success, takes the last spot)
-    booking_data = {"class_id": low_cap_class_id, "member_id": member_id}
-    client.post("/bookings", headers={"Authorization": f"Bearer {get_member_token(client)}"}, json=booking_data)
+    booking_data = {"class_id": low_cap_class_id, "member_id": member_auth["id"]}
+    await client.post("/bookings", headers={"Authorization": f"Bearer {member_auth['token']}"}, json=booking_data)
     
     # 3. Second booking (Failure - Capacity Full)
-    response_fail = client.post(
+    response_fail = await client.post(
         "/bookings",
-        headers={"Authorization": f"Bearer {get_member_token(client)}"},
+        headers={"Authorization": f"Bearer {member_auth['token']}"},
         json=booking_data
     )
     assert response_fail.status_code == 409 # Conflict (Class is fully booked)
 
-def test_get_my_bookings_success(client, db_session):
+async def test_get_my_bookings_success(client, member_auth, created_class):
     """Tests retrieving the current user's bookings."""
-    member_token = get_member_token(client)
-    
-    response = client.get(
+    await client.post(
+        "/bookings",
+        headers={"Authorization": f"Bearer {member_auth['token']}"},
+        json={"class_id": created_class["id"], "member_id": member_auth["id"]}
+    )
+
+    response = await client.get(
         "/users/me/bookings",
-        headers={"Authorization": f"Bearer {member_token}"}
+        headers={"Authorization": f"Bearer {member_auth['token']}"}
     )
     assert response.status_code == 200
     data = response.json()
     assert isinstance(data, list)
-    # Check that at least the class_id from test_book_class_member_success is present
-    assert any(b["class_id"] == class_id for b in data)
\ No newline at end of file
+    # Check that the booking made above is present
+    assert any(b["class_id"] == created_class["id"] for b in data)
+
+# --- REQUEST TRANSACTION TESTS ---
+
+async def test_get_db_commits_success_and_rolls_back_failure(client, tmp_path, monkeypatch):
+    """Tests the real get_db (no test override): a successful request's writes persist, a failed one's don't."""
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'app.db'}")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    monkeypatch.setattr(database, "SessionLocal", async_sessionmaker(engine, autoflush=False, expire_on_commit=False))
+    monkeypatch.delitem(app.dependency_overrides, get_db)
+
+    # A handler that fails after its write has been flushed
+    real_create_user = crud.create_user
+
+    async def create_user_then_fail(db, user):
+        await real_create_user(db, user)
+        raise HTTPException(status_code=503, detail="Failing on purpose")
+
+    response = await client.post("/register", json={"name": "Kept", "email": "kept@test.com", "password": "password"})
+    assert response.status_code == 201
+    monkeypatch.setattr(crud, "create_user", create_user_then_fail)
+    response = await client.post("/register", json={"name": "Lost", "email": "lost@test.com", "password": "password"})
+    assert response.status_code == 503
+
+    # Read back through a connection of its own, outside any request
+    async with engine.connect() as conn:
+        emails = (await conn.execute(text("SELECT email FROM users"))).scalars().all()
+    await engine.dispose()
+    assert emails == ["kept@test.com"]
+
+# --- DATABASE URL TESTS ---
+
+@pytest.mark.parametrize("url, expected", [
+    ("postgres://u:p@host/db", "postgresql+asyncpg://u:p@host/db"),
+    ("postgresql://u:p@host/db", "postgresql+asyncpg://u:p@host/db"),
+    ("postgresql+psycopg2://u:p@host/db", "postgresql+asyncpg://u:p@host/db"),
+    ("postgresql+psycopg://u:p@host/db", "postgresql+asyncpg://u:p@host/db"),
+    ("sqlite:///./sql_app.db", "sqlite+aiosqlite:///./sql_app.db"),
+    ("sqlite+pysqlite:///./sql_app.db", "sqlite+aiosqlite:///./sql_app.db"),
+])
+def test_to_async_url(url, expected):
+    """Tests that any postgres/sqlite URL ends up on the installed asyncio driver."""
+    assert to_async_url(url) == expected
+
+# --- SCHEMA UPGRADE TESTS ---
+
+async def test_upgrade_schema(tmp_path):
+    """Tests that a first-release database gets the booking counter (filled from existing bookings) and the FK indexes."""
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'legacy.db'}")
+    async with engine.begin() as conn:
+        # The tables as the first release created them
+        await conn.execute(text("CREATE TABLE users (id INTEGER PRIMARY KEY, email VARCHAR NOT NULL, name VARCHAR, hashed_password VARCHAR NOT NULL, role VARCHAR(50), is_active BOOLEAN)"))
+        await conn.execute(text("CREATE TABLE classes (id INTEGER PRIMARY KEY, name VARCHAR NOT NULL, trainer_id INTEGER NOT NULL, max_capacity INTEGER NOT NULL, duration_minutes INTEGER)"))
+        await conn.execute(text("CREATE TABLE bookings (id INTEGER PRIMARY KEY, class_id INTEGER NOT NULL, member_id INTEGER NOT NULL)"))
+        await conn.execute(text("INSERT INTO classes (id, name, trainer_id, max_capacity) VALUES (1, 'Spin', 1, 10), (2, 'Yoga', 1, 10)"))
+        await conn.execute(text("INSERT INTO bookings (class_id, member_id) VALUES (1, 1), (1, 2)"))
+
+    # Run it as init_db does, twice to check it is safe on every deploy
+    for _ in range(2):
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+            await upgrade_schema(conn)
+
+    async with engine.connect() as conn:
+        counts = (await conn.execute(text("SELECT id, current_bookings FROM classes ORDER BY id"))).all()
+        indexes = set((await conn.execute(text("SELECT name FROM sqlite_master WHERE type = 'index'"))).scalars())
+    await engine.dispose()
+    assert counts == [(1, 2), (2, 0)]
+    assert {"ix_classes_trainer_id", "ix_bookings_class_id", "ix_bookings_member_id"} <= indexes
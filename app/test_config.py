@@ -1,10 +1,20 @@
 # app/test_config.py
+import os
 
 # --- Database Configuration ---
-# Use an isolated SQLite file for local testing to ensure fast, clean tests.
-TEST_DATABASE_URL = "sqlite:///./test.db" 
+# In-memory SQLite (shared through a StaticPool in conftest.py), so tests never touch the disk.
+# Set TEST_DB_ON_DISK=1 to use a fresh sqlite file under pytest's tmp dir instead, to inspect
+# data after a run. Either way every run starts from an empty database.
+TEST_DATABASE_URL = "sqlite+aiosqlite://"
+TEST_DB_ON_DISK = os.getenv("TEST_DB_ON_DISK") == "1"
 
 
+# --- Password Hashing ---
+# bcrypt's minimum cost; exported as BCRYPT_ROUNDS (with BCRYPT_ALLOW_WEAK_ROUNDS=1, which lifts
+# the production floor of 10) by conftest.py before the app is imported,
+# which makes every hash/verify in the suite ~256x cheaper than at cost 12.
+BCRYPT_ROUNDS = 4
+
 # --- Test User Data ---
 # These dictionaries mirror the app/schemas.py UserCreate model but include the role for setup
 TEST_MEMBER = {
@@ -30,4 +40,8 @@ TEST_CLASS_DATA = {
     "name": "Morning Yoga",
     "max_capacity": 10,
     "duration_minutes": 75
-}
\ No newline at end of file
+}
+
+def class_payload(trainer_id, **overrides):
+    """Builds a /classes request body from TEST_CLASS_DATA, leaving the shared dict untouched."""
+    return {**TEST_CLASS_DATA, "trainer_id": trainer_id, **overrides}